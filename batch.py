@@ -0,0 +1,149 @@
+import json
+import os
+import sys
+import time
+
+from futoshiki import *
+
+# Results are appended to a JSON lines file as each puzzle finishes. Alongside it
+# is a completion index with one byte per puzzle: DONE, or the number of attempts
+# made so far. An attempt is recorded in the index before the puzzle is run, so a
+# puzzle that crashes the process still uses up one of its attempts.
+
+DONE = 255
+
+TASKS = {
+    "hint": hint_dict,
+    "refutation_scores": lambda grid: refutation_scores(grid).tolist(),
+    "propagation_scores": lambda grid: propagation_scores(grid).tolist(),
+}
+
+
+def read_results(results_path):
+    """Return the records in a results file, skipping partially written lines."""
+    records = []
+    if not os.path.exists(results_path):
+        return records
+    with open(results_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def _truncate_partial_line(results_path):
+    """Remove a partially written last line left by a crash."""
+    if not os.path.exists(results_path):
+        return
+    with open(results_path, "r+b") as f:
+        f.seek(0, 2)
+        end = f.tell()
+        # search backwards for the last newline, a block at a time
+        pos = end
+        while pos > 0:
+            start = max(0, pos - 4096)
+            f.seek(start)
+            i = f.read(pos - start).rfind(b"\n")
+            if i != -1:
+                pos = start + i + 1
+                break
+            pos = start
+        if pos != end:
+            f.truncate(pos)
+
+
+def _load_index(index_path, results_path, size):
+    if os.path.exists(index_path):
+        with open(index_path, "rb") as f:
+            index = bytearray(f.read())
+    else:
+        # rebuild the index from the results
+        index = bytearray(size)
+        for record in read_results(results_path):
+            i = record["index"]
+            if record["status"] == "ok":
+                index[i] = DONE
+            elif index[i] != DONE:
+                index[i] = max(index[i], record["attempt"])
+    if len(index) < size:
+        index.extend(bytes(size - len(index)))
+    with open(index_path, "wb") as f:
+        f.write(index)
+    return index
+
+
+def run(grids, results_path, task="hint", max_attempts=3, indices=None):
+    """Run a task on each grid, writing results to `results_path`.
+
+    The run can be interrupted and restarted: grids that are already done are
+    skipped, and grids that failed are retried until they have been attempted
+    `max_attempts` times. If `indices` is given, only those grids are run.
+
+    Return the number of grids that were run.
+    """
+    fn = TASKS[task] if isinstance(task, str) else task
+    index_path = results_path + ".index"
+    index = _load_index(index_path, results_path, len(grids))
+    if indices is None:
+        indices = range(len(grids))
+
+    _truncate_partial_line(results_path)
+    count = 0
+    with open(results_path, "a", encoding="utf-8") as results, open(
+        index_path, "r+b"
+    ) as index_file:
+
+        def set_status(i, status):
+            index[i] = status
+            index_file.seek(i)
+            index_file.write(bytes([status]))
+            index_file.flush()
+
+        for i in indices:
+            if index[i] == DONE or index[i] >= max_attempts:
+                continue
+            attempt = index[i] + 1
+            set_status(i, attempt)
+            record = {"index": i, "attempt": attempt}
+            start = time.perf_counter()
+            try:
+                result = fn(grids[i])
+                record.update(status="ok", result=result)
+            except Exception as e:
+                record.update(status="error", error=repr(e))
+            record["seconds"] = time.perf_counter() - start
+            results.write(json.dumps(record) + "\n")
+            results.flush()
+            os.fsync(results.fileno())
+            if record["status"] == "ok":
+                set_status(i, DONE)
+            count += 1
+    return count
+
+
+def slowest(results_path, k=10):
+    """Return the k successful records that took the longest, slowest first."""
+    latest = {}
+    for record in read_results(results_path):
+        if record["status"] == "ok":
+            latest[record["index"]] = record
+    return sorted(latest.values(), key=lambda r: r["seconds"], reverse=True)[:k]
+
+
+if __name__ == "__main__":
+    from corpus import Corpus, is_corpus, read_text
+
+    if len(sys.argv) < 3:
+        print(f"Usage: python batch.py <corpus> <results> [{'|'.join(TASKS)}]")
+        sys.exit(1)
+    corpus_path, results_path = sys.argv[1:3]
+    task = sys.argv[3] if len(sys.argv) > 3 else "hint"
+    if is_corpus(corpus_path):
+        grids = Corpus(corpus_path)
+    else:
+        grids = list(read_text(corpus_path))
+    print(f"Ran {run(grids, results_path, task)} grids")
+    for record in slowest(results_path, k=5):
+        print(f"Grid {record['index']}: {record['seconds']:.3f}s")
@@ -0,0 +1,199 @@
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+from z3 import Or, Solver, unsat
+
+from futoshiki import *
+from futoshiki import _get_variables_and_constraints, _peak_rss
+from puzzles import README
+
+# the puzzles from the README
+README_GRIDS = [Grid(rep) for rep in README]
+
+
+def random_grid(n, rng, p_value=0.3, p_ineq=0.3):
+    """Return a random grid that has at least one solution.
+
+    The solution is a shuffled Latin square, then a random subset of its values
+    and the inequalities between neighbouring cells are revealed.
+    """
+    solution = (np.add.outer(np.arange(n), np.arange(n)) % n) + 1
+    solution = solution[rng.permutation(n)][:, rng.permutation(n)]
+    values = solution * (rng.random((n, n)) < p_value)
+    across = np.sign(solution[:, :-1] - solution[:, 1:])
+    across *= rng.random((n, n - 1)) < p_ineq
+    down = np.sign(solution[:-1, :] - solution[1:, :])
+    down *= rng.random((n - 1, n)) < p_ineq
+    return Grid(values=values, across=across, down=down)
+
+
+def has_unique_solution(grid):
+    solution = solve(grid)
+    if solution is None:
+        return False
+    # look for a solution that differs in at least one cell
+    ctx = get_context()
+    X, constraints = _get_variables_and_constraints(grid, ctx)
+    s = Solver(ctx=ctx)
+    s.add(constraints)
+    s.add(Or([X[r][c] != int(v) for (r, c), v in np.ndenumerate(solution.values)]))
+    return s.check() == unsat
+
+
+def random_puzzle(n, rng, p_ineq=0.3):
+    """Return a random grid with a unique solution.
+
+    Starting from a random grid with all of its values revealed, values are removed
+    in a random order as long as the solution stays unique.
+    """
+    grid = random_grid(n, rng, p_value=1, p_ineq=p_ineq)
+    for i in rng.permutation(n * n):
+        r, c = divmod(int(i), n)
+        candidate = grid.set(r, c, 0)
+        if has_unique_solution(candidate):
+            grid = candidate
+    return grid
+
+
+def random_corpus(n, size, seed=0, unique=False):
+    rng = np.random.default_rng(seed)
+    if unique:
+        return [random_puzzle(n, rng) for _ in range(size)]
+    return [random_grid(n, rng) for _ in range(size)]
+
+
+def bench_batch(n=4, size=200):
+    """Compare calling hint on each grid with hint_batch."""
+    grids = random_corpus(n, size)
+
+    start = time.perf_counter()
+    sequential = [hint(grid) for grid in grids]
+    sequential_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = hint_batch(grids)
+    batch_time = time.perf_counter() - start
+
+    assert batch == sequential
+    print(f"hint on {size} {n}x{n} grids: {sequential_time:.3f}s")
+    print(f"hint_batch on {size} {n}x{n} grids: {batch_time:.3f}s")
+
+
+def solve_with_hints(grid, scheduler):
+    """Fill in a grid one hint at a time, using the solution for the value."""
+    solution = solve(grid)
+    while not grid.filled():
+        r, c, name, suggestion = hint(grid, scheduler=scheduler)
+        grid = grid.set(r, c, solution.values[r, c])
+
+
+def bench_rules(n=5, size=20):
+    """Report how often each rule provides the hint while solving a corpus, with
+    and without the intermediate rules."""
+    grids = random_corpus(n, size, unique=True)
+    rules = default_rules()
+    for label, scheduler in (
+        ("simple rules", RuleScheduler(rules[:3] + rules[-1:])),
+        ("all rules", RuleScheduler(rules)),
+    ):
+        start = time.perf_counter()
+        for grid in grids:
+            solve_with_hints(grid, scheduler)
+        elapsed = time.perf_counter() - start
+        hits = {name: stats.hits for name, stats in scheduler.stats.items()}
+        total = sum(hits.values())
+        print(f"{label} on {size} {n}x{n} grids: {elapsed:.3f}s")
+        for name, count in hits.items():
+            print(f"  {name}: {count}")
+        print(f"  refutation reached for {hits['refutation'] / total:.1%} of hints")
+
+
+def rank_correlation(a, b):
+    """Spearman's rank correlation coefficient, ignoring ties."""
+    ranks_a = np.argsort(np.argsort(a))
+    ranks_b = np.argsort(np.argsort(b))
+    return np.corrcoef(ranks_a, ranks_b)[0, 1]
+
+
+def bench_scores(grids=README_GRIDS):
+    """Compare propagation scores with proof-length refutation scores."""
+    for i, grid in enumerate(grids):
+        start = time.perf_counter()
+        proof = refutation_scores(grid)
+        proof_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        native = propagation_scores(grid)
+        native_time = time.perf_counter() - start
+
+        empty = grid.values == 0
+        rule = MinimumRefutationScoreRule()
+        proof_cell = tuple(int(x) for x in rule.apply(grid)[:2])
+        rule = MinimumRefutationScoreRule(scorer=propagation_scores)
+        native_cell = tuple(int(x) for x in rule.apply(grid)[:2])
+        print(f"README grid {i + 1} ({grid.n}x{grid.n}):")
+        print(f"  refutation_scores: {proof_time:.3f}s, cell {proof_cell}")
+        print(f"  propagation_scores: {native_time:.3f}s, cell {native_cell}")
+        corr = rank_correlation(proof[empty], native[empty])
+        print(f"  rank correlation: {corr:.2f}")
+
+
+def bench_incremental(grids=README_GRIDS):
+    """Compare incremental refutation scores with the push/pop implementation."""
+    for i, grid in enumerate(grids):
+        results = {}
+        for incremental in (False, True):
+            # use a fresh context, since scores depend on the solver's history
+            ctx = Context(proof=True)
+            with counting() as counts:
+                start = time.perf_counter()
+                scores = refutation_scores(grid, ctx, incremental=incremental)
+                elapsed = time.perf_counter() - start
+            masked = np.ma.masked_equal(scores, 0)
+            cell = np.unravel_index(masked.argmin(), scores.shape)
+            cell = tuple(int(x) for x in cell)
+            results[incremental] = scores
+            label = "incremental" if incremental else "push/pop"
+            print(
+                f"README grid {i + 1} {label}: {elapsed:.3f}s, "
+                f"{counts['check']} checks, cell {cell}"
+            )
+        empty = grid.values == 0
+        corr = rank_correlation(results[False][empty], results[True][empty])
+        print(f"  rank correlation: {corr:.2f}")
+
+
+def _peak_memory(grid, kwargs):
+    before = _peak_rss()
+    start = time.perf_counter()
+    refutation_scores(grid, **kwargs)
+    elapsed = time.perf_counter() - start
+    return elapsed, before, _peak_rss()
+
+
+def bench_memory(grids=README_GRIDS, **kwargs):
+    """Report the peak memory of refutation scores for each grid.
+
+    Each grid is scored in a new process, so its peak resident set size is not
+    affected by the other grids. Keyword arguments are passed on to
+    `refutation_scores`, e.g. `recycle_every` or `memory_limit`.
+    """
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        for i, grid in enumerate(grids):
+            elapsed, before, peak = pool.apply(_peak_memory, (grid, kwargs))
+            print(
+                f"Grid {i + 1} {kwargs}: {elapsed:.3f}s, "
+                f"peak {peak / 2**20:.1f} MiB ({(peak - before) / 2**20:+.1f} MiB)"
+            )
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    bench_batch(n)
+    bench_rules(n)
+    bench_scores()
+    bench_incremental()
+    bench_memory()
+    bench_memory(recycle_every=50)
@@ -0,0 +1,195 @@
+import sys
+
+import numpy as np
+
+from futoshiki import Grid
+
+# A binary corpus is a header followed by fixed-size records, one per grid. The
+# header is the magic bytes, a version byte, n, and padding. Each record is the
+# n * n values, then the n * (n - 1) across and (n - 1) * n down inequalities,
+# all stored as single bytes (inequalities are signed).
+
+MAGIC = b"FUTOSHKI"
+VERSION = 1
+HEADER_SIZE = 16
+
+
+def record_size(n):
+    return n * n + 2 * n * (n - 1)
+
+
+def _header(n):
+    header = np.zeros(HEADER_SIZE, dtype=np.uint8)
+    header[: len(MAGIC)] = np.frombuffer(MAGIC, dtype=np.uint8)
+    header[len(MAGIC)] = VERSION
+    header[len(MAGIC) + 1] = n
+    return header.tobytes()
+
+
+def _read_header(f):
+    header = f.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or header[: len(MAGIC)] != MAGIC:
+        raise ValueError("Not a binary Futoshiki corpus")
+    if header[len(MAGIC)] != VERSION:
+        raise ValueError(f"Unsupported corpus version {header[len(MAGIC)]}")
+    return header[len(MAGIC) + 1]
+
+
+def _to_record(grid):
+    return np.concatenate(
+        [
+            np.asarray(grid.values, dtype=np.uint8).ravel(),
+            np.asarray(grid.across, dtype=np.int8).view(np.uint8).ravel(),
+            np.asarray(grid.down, dtype=np.int8).view(np.uint8).ravel(),
+        ]
+    )
+
+
+def _from_record(record, n):
+    """Return a grid whose arrays are views of a record, without copying."""
+    a = n * n
+    b = a + n * (n - 1)
+    return Grid(
+        values=record[:a].reshape(n, n),
+        across=record[a:b].view(np.int8).reshape(n, n - 1),
+        down=record[b:].view(np.int8).reshape(n - 1, n),
+    )
+
+
+def is_corpus(path):
+    """Return whether a file starts with the header of a binary corpus."""
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _count_records(path, size):
+    with open(path, "rb") as f:
+        f.seek(0, 2)
+        end = f.tell()
+    count, partial = divmod(end - HEADER_SIZE, size)
+    if partial:
+        raise ValueError(f"Truncated corpus, {path} ends with a partial record")
+    return count
+
+
+def write_corpus(path, grids):
+    """Write grids, which must all be the same size, to a binary corpus file."""
+    n = None
+    with open(path, "wb") as f:
+        for grid in grids:
+            if n is None:
+                n = grid.n
+                f.write(_header(n))
+            elif grid.n != n:
+                raise ValueError("All grids in a corpus must be the same size")
+            f.write(_to_record(grid).tobytes())
+        if n is None:
+            raise ValueError("Cannot write an empty corpus")
+
+
+class Corpus:
+    """A memory-mapped binary corpus, with random access to its grids.
+
+    The arrays of each grid are views of the file, so reading a grid does not
+    copy its data. The file is mapped copy-on-write, so grids can be changed in
+    place, but the changes are private to the process and are never saved.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.n = _read_header(f)
+        self.path = path
+        self.record_size = record_size(self.n)
+        count = _count_records(path, self.record_size)
+        records = np.memmap(
+            path,
+            dtype=np.uint8,
+            mode="c",
+            offset=HEADER_SIZE,
+            shape=(count, self.record_size),
+        )
+        # a plain array view of the map is much faster to slice than a memmap
+        self.records = records.view(np.ndarray)
+
+    def __len__(self):
+        return self.records.shape[0]
+
+    def __getitem__(self, i):
+        return _from_record(self.records[i], self.n)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def offset(self, i):
+        """Return the byte offset of record i in the file."""
+        return HEADER_SIZE + i * self.record_size
+
+
+def iter_corpus(path, start=None, stop=None, chunk_size=1024):
+    """Stream the grids from a binary corpus file, reading a chunk at a time.
+
+    If byte offsets `start` and `stop` are given, only the records whose first
+    byte lies in that range are read. This means a corpus can be split into
+    shards at arbitrary byte offsets and each record will be in exactly one
+    shard.
+    """
+    with open(path, "rb") as f:
+        n = _read_header(f)
+        size = record_size(n)
+        end = HEADER_SIZE + _count_records(path, size) * size
+        start = HEADER_SIZE if start is None else max(start, HEADER_SIZE)
+        stop = end if stop is None else min(stop, end)
+        first = -(-(start - HEADER_SIZE) // size)  # round up
+        last = -(-(stop - HEADER_SIZE) // size)
+        f.seek(HEADER_SIZE + first * size)
+        for i in range(first, last, chunk_size):
+            count = min(chunk_size, last - i)
+            chunk = np.fromfile(f, dtype=np.uint8, count=count * size)
+            for record in chunk.reshape(-1, size):
+                yield _from_record(record, n)
+
+
+def read_text(path):
+    """Read grids from a text file in the format used by `Grid`.
+
+    Grids may be separated by blank lines. The size of each grid is found from
+    its first line, so blank lines within a grid are allowed.
+    """
+    with open(path, encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    i = 0
+    while i < len(lines):
+        if lines[i].strip() == "":
+            i += 1
+            continue
+        n = (len(lines[i].rstrip()) + 3) // 4
+        yield Grid("\n".join(lines[i : i + 2 * n - 1]))
+        i += 2 * n - 1
+
+
+def write_text(path, grids):
+    with open(path, "w", encoding="utf-8") as f:
+        for i, grid in enumerate(grids):
+            if i > 0:
+                f.write("\n")
+            f.write(str(grid))
+
+
+def text_to_binary(src, dst):
+    write_corpus(dst, read_text(src))
+
+
+def binary_to_text(src, dst):
+    write_text(dst, iter_corpus(src))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] not in ("to-binary", "to-text"):
+        print("Usage: python corpus.py to-binary|to-text <src> <dst>")
+        sys.exit(1)
+    command, src, dst = sys.argv[1:]
+    if command == "to-binary":
+        text_to_binary(src, dst)
+    else:
+        binary_to_text(src, dst)
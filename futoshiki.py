@@ -1,7 +1,96 @@
+import contextlib
+import itertools
+import os
+import sys
+import threading
+import time
+import warnings
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from z3 import And, Distinct, Int, Solver, sat, set_param, unsat
+from z3 import (
+    And,
+    Bool,
+    Context,
+    Distinct,
+    Implies,
+    Int,
+    Solver,
+    Z3Exception,
+    sat,
+    unsat,
+)
+
+# counts of notable events, such as solver checks or Z3 calls avoided by the
+# precheck
+stats = Counter()
+
+# functions called with each event and its count, see `counting`
+_hooks = []
+
+
+def _record(event, count=1):
+    stats[event] += count
+    for hook in _hooks:
+        hook(event, count)
+
+
+@contextlib.contextmanager
+def counting():
+    """Count the events recorded while the block runs, on any thread.
+
+    Events are "solver" for each Z3 solver created, "check" for each check
+    call, "copy" for each grid copy, "recycle" for each solver rebuilt to bound
+    memory, and "z3_calls_avoided" for consistency checks decided without Z3.
+    """
+    counts = Counter()
+
+    def hook(event, count):
+        counts[event] += count
+
+    _hooks.append(hook)
+    try:
+        yield counts
+    finally:
+        _hooks.remove(hook)
+
+
+def _solver(ctx):
+    _record("solver")
+    return Solver(ctx=ctx)
+
+
+class Cancelled(Exception):
+    """Raised in a thread whose work is no longer needed."""
 
-set_param(proof=True)
+
+def _check(s, *assumptions):
+    cancel = getattr(_contexts, "cancel", None)
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+    _record("check")
+    return s.check(*assumptions)
+
+
+_contexts = threading.local()
+
+
+def get_context():
+    """Return the Z3 context for the current thread, creating it on first use.
+
+    Z3 contexts are not thread safe, so each thread gets its own. Contexts have
+    proof generation enabled, so they can be passed to `refutation_scores`,
+    although by default it scores in a new context of its own.
+    """
+    ctx = getattr(_contexts, "ctx", None)
+    if ctx is None:
+        ctx = _contexts.ctx = Context(proof=True)
+    return ctx
+
+
+def _context(ctx):
+    return get_context() if ctx is None else ctx
 
 
 class Grid:
@@ -16,6 +105,8 @@ class Grid:
             self.across = across
             self.down = down
         self.n = self.values.shape[0]
+        self._chains = None
+        self._cache = {}
 
     @classmethod
     def empty(cls, n):
@@ -87,27 +178,150 @@ class Grid:
         """Set a cell to a value and return the new grid."""
         values = self.values.copy()
         values[r, c] = val
-        return Grid(values=values, across=self.across, down=self.down)
+        _record("copy")
+        grid = Grid(values=values, across=self.across, down=self.down)
+        # the inequalities are unchanged, so the chain index can be shared
+        grid._chains = self._chains
+        return grid
 
     def set_across(self, r, c, val):
         across = self.across.copy()
         across[r, c] = val
+        _record("copy")
         return Grid(values=self.values, across=across, down=self.down)
 
     def set_down(self, r, c, val):
         down = self.down.copy()
         down[r, c] = val
+        _record("copy")
         return Grid(values=self.values, across=self.across, down=down)
 
     def filled(self):
         return np.all(self.values != 0)
 
+    @property
+    def chains(self):
+        """The inequality chain index for this grid, built on first use."""
+        if self._chains is None:
+            self._chains = ChainIndex(self.across, self.down)
+        return self._chains
+
+    def _cached(self, name, fn):
+        # values may be changed in place, so check the cache is still valid
+        key = self.values.tobytes()
+        if self._cache.get("key") != key:
+            self._cache = {"key": key}
+        if name not in self._cache:
+            self._cache[name] = fn()
+        return self._cache[name]
+
+    def bounds(self):
+        """Return arrays of the lowest and highest value each cell can take, from
+        the inequality chains and the values filled in so far."""
+        return self._cached("bounds", lambda: self.chains.bounds(self.values))
+
+    def candidates(self):
+        """Return the candidate values for each cell, as computed by `candidates`."""
+        return self._cached(
+            "candidates", lambda: candidates(self.values, self.across, self.down)
+        )
+
+
+def _chain_bounds(lo, hi, across, down):
+    """Tighten lower and upper bounds along inequality chains until they stop
+    changing. Leading dimensions of the arrays are treated as a batch of grids."""
+    n = lo.shape[-1]
+    lo = lo.copy()
+    hi = hi.copy()
+    a_lt, a_gt = across == -1, across == 1
+    d_lt, d_gt = down == -1, down == 1
+    while True:
+        prev_lo, prev_hi = lo.copy(), hi.copy()
+        # across: cell (i, j) compared with (i, j + 1)
+        left, right = lo[..., :, :-1], lo[..., :, 1:]
+        np.maximum(right, np.where(a_lt, left + 1, 0), out=right)
+        np.maximum(left, np.where(a_gt, right + 1, 0), out=left)
+        left, right = hi[..., :, :-1], hi[..., :, 1:]
+        np.minimum(left, np.where(a_lt, right - 1, n + 1), out=left)
+        np.minimum(right, np.where(a_gt, left - 1, n + 1), out=right)
+        # down: cell (i, j) compared with (i + 1, j)
+        top, bottom = lo[..., :-1, :], lo[..., 1:, :]
+        np.maximum(bottom, np.where(d_lt, top + 1, 0), out=bottom)
+        np.maximum(top, np.where(d_gt, bottom + 1, 0), out=top)
+        top, bottom = hi[..., :-1, :], hi[..., 1:, :]
+        np.minimum(top, np.where(d_lt, bottom - 1, n + 1), out=top)
+        np.minimum(bottom, np.where(d_gt, top - 1, n + 1), out=bottom)
+        # clip so that cycles or contradictions can't loop forever
+        np.minimum(lo, n + 1, out=lo)
+        np.maximum(hi, 0, out=hi)
+        if np.array_equal(lo, prev_lo) and np.array_equal(hi, prev_hi):
+            return lo, hi
 
-def is_consistent(grid):
+
+class ChainIndex:
+    """The inequalities of a grid, indexed by the bounds they imply on each cell.
+
+    A cell at the top of an increasing chain of length k can't be less than k, and
+    similarly for the bottom of a decreasing chain, so the structural bounds are
+    the longest paths through the inequality DAG.
+    """
+
+    def __init__(self, across, down):
+        n = across.shape[0]
+        self.across = across
+        self.down = down
+        self.lower, self.upper = _chain_bounds(
+            np.ones((n, n), dtype=int), np.full((n, n), n), across, down
+        )
+
+    def bounds(self, values):
+        """Return the bounds on each cell, taking into account the given values."""
+        values = np.asarray(values, dtype=int)
+        filled = values != 0
+        lo = np.where(filled, np.maximum(values, self.lower), self.lower)
+        hi = np.where(filled, np.minimum(values, self.upper), self.upper)
+        return _chain_bounds(lo, hi, self.across, self.down)
+
+
+def _precheck(grid):
+    """Return False if the grid is obviously inconsistent, True if Z3 is needed
+    to decide."""
+    n = grid.n
+    values = grid.values
+
+    # values out of range
+    if np.any((values < 0) | (values > n)):
+        return False
+
+    # duplicate values in a row or column
+    onehot = values[..., np.newaxis] == np.arange(1, n + 1)
+    if np.any(onehot.sum(axis=0) > 1) or np.any(onehot.sum(axis=1) > 1):
+        return False
+
+    def violated(ineq, a, b):
+        # ineq is -1 for a < b, and 1 for a > b
+        filled = (a != 0) & (b != 0)
+        less = (ineq == -1) & ((filled & (a >= b)) | (a == n) | (b == 1))
+        greater = (ineq == 1) & ((filled & (a <= b)) | (a == 1) | (b == n))
+        return np.any(less | greater)
+
+    if violated(grid.across, values[:, :-1], values[:, 1:]):
+        return False
+    if violated(grid.down, values[:-1, :], values[1:, :]):
+        return False
+    return True
+
+
+def is_consistent(grid, ctx=None):
+    if not _precheck(grid):
+        _record("z3_calls_avoided")
+        return False
+
+    ctx = _context(ctx)
     n = grid.n
 
     # a variable for each cell (those undefined will not be used below)
-    X = [[Int("x_%s_%s" % (i + 1, j + 1)) for j in range(n)] for i in range(n)]
+    X = [[Int("x_%s_%s" % (i + 1, j + 1), ctx) for j in range(n)] for i in range(n)]
 
     # each (defined) cell contains a value in {1, ..., n}
     cells_c = [
@@ -139,7 +353,7 @@ def is_consistent(grid):
 
     # a variable for undefined cells that are only used for inequalities
     # this is for checking consistency of "1 > *" for example
-    U = [[Int("u_%s_%s" % (i + 1, j + 1)) for j in range(n)] for i in range(n)]
+    U = [[Int("u_%s_%s" % (i + 1, j + 1), ctx) for j in range(n)] for i in range(n)]
     undefined_c = []
 
     def get(i, j):
@@ -175,16 +389,16 @@ def is_consistent(grid):
     ]
 
     # solve
-    s = Solver()
+    s = _solver(ctx)
     s.add(cells_c + rows_c + cols_c + ineq_c + instance_c + undefined_c)
-    return s.check() == sat
+    return _check(s) == sat
 
 
-def _get_variables_and_constraints(grid):
+def _get_variables_and_constraints(grid, ctx):
     n = grid.n
 
     # a variable for each cell
-    X = [[Int("x_%s_%s" % (i + 1, j + 1)) for j in range(n)] for i in range(n)]
+    X = [[Int("x_%s_%s" % (i + 1, j + 1), ctx) for j in range(n)] for i in range(n)]
 
     # each cell contains a value in {1, ..., n}
     cells_c = [And(1 <= X[i][j], X[i][j] <= n) for i in range(n) for j in range(n)]
@@ -224,11 +438,12 @@ def _get_variables_and_constraints(grid):
     return X, cells_c + rows_c + cols_c + ineq_c + instance_c
 
 
-def solve(grid):
-    s = Solver()
-    X, constraints = _get_variables_and_constraints(grid)
+def solve(grid, ctx=None):
+    ctx = _context(ctx)
+    s = _solver(ctx)
+    X, constraints = _get_variables_and_constraints(grid, ctx)
     s.add(constraints)
-    if s.check() == sat:
+    if _check(s) == sat:
         m = s.model()
         n = grid.n
         values = np.empty((n, n), dtype=int)
@@ -240,13 +455,77 @@ def solve(grid):
         return None
 
 
-def refutation_scores(grid):
-    X, constraints = _get_variables_and_constraints(grid)
-    s = Solver()
-    s.set(unsat_core=True)
-    # TODO: why do scores differ if _get_variables_and_constraints is called here?
-    s.add(constraints)
+def _rss():
+    """Return the current resident set size of this process in bytes, or None if
+    it can't be read, as on systems without /proc."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _proof_length(s):
+    """Return the number of lines in the proof of the last unsat check.
+
+    Lines are counted without splitting the proof's text, and the proof isn't
+    kept alive after it is measured.
+    """
+    return s.proof().sexpr().count("\n") + 1
+
+
+def refutation_scores(
+    grid, ctx=None, incremental=False, recycle_every=None, memory_limit=None
+):
+    """Return the refutation score for each cell, using Z3 proof lengths.
+
+    Proof lengths depend on the history of the Z3 context, so unless `ctx` is
+    given the scores are computed in a new context, which makes them the same
+    for every call on the same grid.
 
+    By default each candidate is checked in its own solver scope, which is
+    discarded afterwards. If `incremental` is True, see
+    `_incremental_refutation_scores`.
+
+    Proof-enabled contexts keep growing as they are used, so for large grids
+    the scores can be computed in a memory-bounded mode. If `recycle_every` is
+    given, the solver is rebuilt in a new context after that many checks. If
+    `memory_limit` (in bytes) is given, the solver is rebuilt whenever the
+    process is over the limit, and MemoryError is raised if it is still over
+    the limit afterwards. Recycling changes the solver's history, so scores may
+    differ slightly from those computed without it. The peak memory use never
+    drops, so it can't be used instead of the current memory use, and
+    `memory_limit` is ignored with a warning where that can't be read.
+    """
+    if memory_limit is not None and _rss() is None:
+        warnings.warn("Can't read the current memory use, so memory_limit is ignored")
+        memory_limit = None
+    bounded = recycle_every is not None or memory_limit is not None
+    ctx = Context(proof=True) if ctx is None else ctx
+    if incremental:
+        if bounded:
+            raise ValueError("The incremental mode cannot be memory bounded")
+        return _incremental_refutation_scores(grid, ctx)
+
+    def new_solver(ctx):
+        X, constraints = _get_variables_and_constraints(grid, ctx)
+        s = _solver(ctx)
+        s.set(unsat_core=True)
+        # TODO: why do scores differ if _get_variables_and_constraints is called here?
+        s.add(constraints)
+        return X, s
+
+    X, s = new_solver(ctx)
+    checks = 0
     n = grid.n
     scores = np.zeros((n, n), dtype=int)
     for r in range(0, n):
@@ -254,20 +533,204 @@ def refutation_scores(grid):
             if grid.values[r, c] != 0:
                 continue
             for v in range(1, n + 1):
+                if bounded and (
+                    (recycle_every is not None and checks >= recycle_every)
+                    or (memory_limit is not None and _rss() > memory_limit)
+                ):
+                    # drop every reference to the old context so Z3 frees it
+                    X = s = ctx = None
+                    ctx = Context(proof=True)
+                    X, s = new_solver(ctx)
+                    checks = 0
+                    _record("recycle")
+                    if memory_limit is not None:
+                        rss = _rss()
+                        if rss > memory_limit:
+                            raise MemoryError(
+                                f"Memory use {rss} is over the limit {memory_limit}"
+                            )
                 s.push()
                 s.add(X[r][c] == v)
-                if s.check() == unsat:
+                checks += 1
+                if _check(s) == unsat:
                     # use proof length as proxy for score
-                    scores[r, c] += len(s.proof().sexpr().splitlines())
+                    scores[r, c] += _proof_length(s)
                 s.pop()
     return scores
 
 
+def _incremental_refutation_scores(grid, ctx):
+    """Compute refutation scores with a single solver that is never popped.
+
+    Each candidate is checked as an assumption literal, so clauses that Z3 learns
+    are kept for later candidates. (Adding each refuted candidate as a lemma too
+    makes the scores of later cells depend much more on the order they are
+    checked in.) The values in a satisfying model are known to be possible, so
+    they are not checked. If a refutation doesn't depend on its assumption (an
+    empty unsat core) the grid itself is inconsistent, so all the remaining
+    candidates are refuted by the same proof.
+
+    Unsat cores are only used for that case. Each check has a single
+    assumption, so a core can't show that other candidates are implied by an
+    earlier refutation, and skipping refuted candidates would leave their
+    cells without a score, so no other candidates are skipped.
+    """
+    X, constraints = _get_variables_and_constraints(grid, ctx)
+    s = _solver(ctx)
+    s.set(unsat_core=True)
+    s.add(constraints)
+
+    n = grid.n
+    scores = np.zeros((n, n), dtype=int)
+    possible = np.zeros((n, n, n), dtype=bool)
+    inconsistent = None
+    for r in range(0, n):
+        for c in range(0, n):
+            if grid.values[r, c] != 0:
+                continue
+            for v in range(1, n + 1):
+                if possible[r, c, v - 1]:
+                    continue
+                if inconsistent is not None:
+                    scores[r, c] += inconsistent
+                    continue
+                a = Bool("a_%s_%s_%s" % (r + 1, c + 1, v), ctx)
+                s.add(Implies(a, X[r][c] == v))
+                result = _check(s, a)
+                if result == unsat:
+                    score = _proof_length(s)
+                    scores[r, c] += score
+                    if len(s.unsat_core()) == 0:
+                        inconsistent = score
+                elif result == sat:
+                    m = s.model()
+                    for i in range(n):
+                        for j in range(n):
+                            possible[i, j, m.evaluate(X[i][j]).as_long() - 1] = True
+    return scores
+
+
+REFUTED, SOLVED, UNKNOWN = "refuted", "solved", "unknown"
+
+
+def _propagate_round(cands, across, down):
+    """Apply one round of propagation to an (n, n, n) array of candidate values,
+    where filled cells have a single candidate."""
+    n = cands.shape[0]
+    vals = np.arange(1, n + 1)
+
+    # remove the value of each single from the other cells in its row and column
+    singles = cands & (cands.sum(axis=-1) == 1)[..., np.newaxis]
+    in_row = singles.any(axis=1)[:, np.newaxis, :]
+    in_col = singles.any(axis=0)[np.newaxis, :, :]
+    cands = cands & (singles | ~(in_row | in_col))
+
+    # a value with only one candidate cell in a row or column must go there
+    for axis in (1, 0):
+        hidden = cands & np.expand_dims(cands.sum(axis=axis) == 1, axis)
+        cands = np.where(hidden.any(axis=-1)[..., np.newaxis], hidden, cands)
+
+    # restrict each cell to the bounds implied by the inequalities
+    any_cand = cands.any(axis=-1)
+    lo = np.where(any_cand, cands.argmax(axis=-1) + 1, n + 1)
+    hi = np.where(any_cand, n - cands[..., ::-1].argmax(axis=-1), 0)
+    lo, hi = _chain_bounds(lo, hi, across, down)
+    return cands & (lo[..., np.newaxis] <= vals) & (vals <= hi[..., np.newaxis])
+
+
+def _status(cands):
+    counts = cands.sum(axis=-1)
+    if np.any(counts == 0):
+        return REFUTED
+    # two cells in a row or column with the same single value
+    singles = cands & (counts == 1)[..., np.newaxis]
+    if np.any(singles.sum(axis=0) > 1) or np.any(singles.sum(axis=1) > 1):
+        return REFUTED
+    # a value that can't go anywhere in a row or column
+    if np.any(cands.sum(axis=0) == 0) or np.any(cands.sum(axis=1) == 0):
+        return REFUTED
+    if np.all(counts == 1):
+        return SOLVED
+    return None
+
+
+def _refute(cands, across, down, max_depth):
+    """Try to refute the candidates by propagation, then by search over the cell
+    with the fewest candidates down to `max_depth` levels.
+
+    Return the outcome (REFUTED, SOLVED or UNKNOWN) and the number of propagation
+    rounds it took.
+    """
+    rounds = 0
+    while True:
+        status = _status(cands)
+        if status is not None:
+            return status, rounds
+        propagated = _propagate_round(cands, across, down)
+        rounds += 1
+        if np.array_equal(propagated, cands):
+            break
+        cands = propagated
+
+    if max_depth == 0:
+        return UNKNOWN, rounds
+    counts = np.where(cands.sum(axis=-1) > 1, cands.sum(axis=-1), cands.shape[0] + 1)
+    r, c = np.unravel_index(counts.argmin(), counts.shape)
+    outcome = REFUTED
+    for v in np.flatnonzero(cands[r, c]):
+        branch = cands.copy()
+        branch[r, c] = False
+        branch[r, c, v] = True
+        status, branch_rounds = _refute(branch, across, down, max_depth - 1)
+        rounds += branch_rounds
+        if status == SOLVED:
+            return SOLVED, rounds
+        if status == UNKNOWN:
+            outcome = UNKNOWN
+    return outcome, rounds
+
+
+def propagation_scores(grid, max_depth=3):
+    """Return refutation scores computed by propagating constraints, without Z3.
+
+    The score for a cell is the number of propagation rounds needed to reach a
+    contradiction for each of its wrong values, summed. Propagation removes the
+    values of filled cells from their row and column, fills values that have
+    only one place to go in a row or column, and applies inequality bounds.
+    When propagation gets stuck a limited-depth search is used. Values that
+    can't be refuted within the depth limit contribute the rounds spent trying,
+    and values that lead to a solution contribute nothing.
+    """
+    n = grid.n
+    values = np.asarray(grid.values, dtype=int)
+    base = np.ones((n, n, n), dtype=bool)
+    filled = values != 0
+    base[filled] = values[filled, np.newaxis] == np.arange(1, n + 1)
+
+    scores = np.zeros((n, n), dtype=int)
+    for r in range(n):
+        for c in range(n):
+            if filled[r, c]:
+                continue
+            for v in range(n):
+                cands = base.copy()
+                cands[r, c] = False
+                cands[r, c, v] = True
+                status, rounds = _refute(cands, grid.across, grid.down, max_depth)
+                if status != SOLVED:
+                    # count at least one round, even for an immediate contradiction
+                    scores[r, c] += max(rounds, 1)
+    return scores
+
+
 class RowAndColumnExclusionRule:
     """For a given cell there is only one value that can go into the cell."""
 
-    def __init__(self):
+    def __init__(self, ctx=None):
+        self.ctx = ctx
         self.name = "exclusion"
+        # whether the rule always gives a hint when can_apply is True
+        self.exact = True
 
     def apply(self, grid, r=None, c=None):
         if r is None:
@@ -285,32 +748,35 @@ class RowAndColumnExclusionRule:
                 vals = self.possible_values(grid, r, c)
                 if len(vals) == 1:
                     val = next(iter(vals))
-                    suggestion = f"What is the only value that can go in row {r + 1}, column {c + 1}?"
-                    return r, c, val, suggestion
+                    return r, c, val, self.suggestion(r, c, val)
         return None
 
+    def iter_apply(self, grid):
+        cands = grid.candidates()
+        for r, c in np.argwhere(cands.sum(axis=-1) == 1):
+            val = int(cands[r, c].argmax()) + 1
+            yield int(r), int(c), val, self.suggestion(r, c, val)
+
+    def suggestion(self, r, c, val):
+        return f"What is the only value that can go in row {r + 1}, column {c + 1}?"
+
+    def can_apply(self, grid, cands):
+        return np.any((cands.sum(axis=-1) == 1) & (grid.values == 0))
+
     def possible_values(self, grid, r, c):
-        vals = set(range(1, grid.n + 1))
-        for val in range(1, grid.n + 1):
-            if not is_consistent(grid.set(r, c, val)):
-                vals.discard(val)
-        return vals
+        return {int(v) + 1 for v in np.flatnonzero(grid.candidates()[r, c])}
 
 
 class RowInclusionRule:
     """For a given row there exists only one cell which can contain a given value."""
 
-    def __init__(self):
+    def __init__(self, ctx=None):
+        self.ctx = ctx
         self.name = "row inclusion"
+        self.exact = True
 
     def possible_cells(self, grid, val, r):
-        cells = []
-        for c in range(grid.n):
-            if grid.values[r, c] != 0:
-                continue
-            if is_consistent(grid.set(r, c, val)):
-                cells.append((r, c))
-        return cells
+        return [(r, int(c)) for c in np.flatnonzero(grid.candidates()[r, :, val - 1])]
 
     def apply(self, grid, r=None):
         if r is None:
@@ -322,28 +788,33 @@ class RowInclusionRule:
                 cells = self.possible_cells(grid, val, r=r)
                 if len(cells) == 1:
                     r, c = cells[0]
-                    # Less of a hint: Which cell in row r does one number have to go?
-                    suggestion = (
-                        f"Where in row {r + 1} does the number {val} have to go?"
-                    )
-                    return r, c, val, suggestion
+                    return r, c, val, self.suggestion(r, c, val)
         return None
 
+    def iter_apply(self, grid):
+        cands = grid.candidates()
+        for r, v in np.argwhere(cands.sum(axis=1) == 1):
+            c, val = int(cands[r, :, v].argmax()), int(v) + 1
+            yield int(r), c, val, self.suggestion(r, c, val)
+
+    def suggestion(self, r, c, val):
+        # Less of a hint: Which cell in row r does one number have to go?
+        return f"Where in row {r + 1} does the number {val} have to go?"
+
+    def can_apply(self, grid, cands):
+        return np.any(cands.sum(axis=1) == 1)
+
 
 class ColumnInclusionRule:
     """For a given column there exists only one cell which can contain a given value."""
 
-    def __init__(self):
+    def __init__(self, ctx=None):
+        self.ctx = ctx
         self.name = "column inclusion"
+        self.exact = True
 
     def possible_cells(self, grid, val, c):
-        cells = []
-        for r in range(grid.n):
-            if grid.values[r, c] != 0:
-                continue
-            if is_consistent(grid.set(r, c, val)):
-                cells.append((r, c))
-        return cells
+        return [(int(r), c) for r in np.flatnonzero(grid.candidates()[:, c, val - 1])]
 
     def apply(self, grid, c=None):
         if c is None:
@@ -355,41 +826,531 @@ class ColumnInclusionRule:
                 cells = self.possible_cells(grid, val, c=c)
                 if len(cells) == 1:
                     r, c = cells[0]
-                    # Less of a hint: Which cell in column c does one number have to go?
-                    suggestion = (
-                        f"Where in column {c + 1} does the number {val} have to go?"
-                    )
-                    return r, c, val, suggestion
+                    return r, c, val, self.suggestion(r, c, val)
         return None
 
+    def iter_apply(self, grid):
+        cands = grid.candidates()
+        for c, v in np.argwhere(cands.sum(axis=0) == 1):
+            r, val = int(cands[:, c, v].argmax()), int(v) + 1
+            yield r, int(c), val, self.suggestion(r, c, val)
+
+    def suggestion(self, r, c, val):
+        # Less of a hint: Which cell in column c does one number have to go?
+        return f"Where in column {c + 1} does the number {val} have to go?"
+
+    def can_apply(self, grid, cands):
+        return np.any(cands.sum(axis=0) == 1)
+
+
+def _units(grid):
+    """Yield each row then each column of a grid as a description, the row and
+    column indexes of its cells, and the inequalities between consecutive cells."""
+    n = grid.n
+    for r in range(n):
+        yield f"row {r + 1}", np.full(n, r), np.arange(n), grid.across[r, :]
+    for c in range(n):
+        yield f"column {c + 1}", np.arange(n), np.full(n, c), grid.down[:, c]
+
+
+def _new_singles(before, after):
+    """Yield each cell and value that is forced by the candidates `after`, but
+    wasn't by the candidates `before`."""
+    # a cell with only one candidate value
+    mask = (after.sum(axis=-1) == 1) & (before.sum(axis=-1) > 1)
+    for r, c in np.argwhere(mask):
+        yield int(r), int(c), int(after[r, c].argmax()) + 1
+    # a value with only one candidate cell in a row
+    mask = (after.sum(axis=1) == 1) & (before.sum(axis=1) > 1)
+    for r, v in np.argwhere(mask):
+        yield int(r), int(after[r, :, v].argmax()), int(v) + 1
+    # a value with only one candidate cell in a column
+    mask = (after.sum(axis=0) == 1) & (before.sum(axis=0) > 1)
+    for c, v in np.argwhere(mask):
+        yield int(after[:, c, v].argmax()), int(c), int(v) + 1
+
+
+def _tighten_bounds(grid, cands):
+    """Return candidates restricted to values allowed by the inequalities, given the
+    lowest and highest candidate of each neighbouring cell."""
+    n = grid.n
+    filled = grid.values != 0
+    cands = cands.copy()
+    while True:
+        any_cand = cands.any(axis=-1)
+        lo = np.where(any_cand, cands.argmax(axis=-1) + 1, n + 1)
+        hi = np.where(any_cand, n - cands[..., ::-1].argmax(axis=-1), 0)
+        lo = np.where(filled, grid.values, lo)
+        hi = np.where(filled, grid.values, hi)
+        lo, hi = _chain_bounds(lo, hi, grid.across, grid.down)
+        vals = np.arange(1, n + 1)
+        tightened = (
+            cands & (lo[..., np.newaxis] <= vals) & (vals <= hi[..., np.newaxis])
+        )
+        if np.array_equal(tightened, cands):
+            return cands
+        cands = tightened
+
+
+class ChainEndRule:
+    """The largest number missing from a row or column can't go in a cell that is less
+    than another empty cell in the same row or column, since that cell would need a
+    larger number. Similarly for the smallest missing number."""
+
+    def __init__(self):
+        self.name = "chain end"
+        self.exact = False
+
+    def apply(self, grid):
+        return next(self.iter_apply(grid), None)
+
+    def iter_apply(self, grid):
+        cands = grid.candidates()
+        for unit, rs, cs, ineq in _units(grid):
+            values = grid.values[rs, cs]
+            missing = sorted(set(range(1, grid.n + 1)) - set(values))
+            if len(missing) < 2:
+                continue
+            empty = values == 0
+            lt, gt = ineq == -1, ineq == 1
+            # cells that are less than, or greater than, an empty cell in the unit
+            lesser = np.zeros(grid.n, dtype=bool)
+            greater = np.zeros(grid.n, dtype=bool)
+            lesser[:-1] |= lt & empty[1:]
+            lesser[1:] |= gt & empty[:-1]
+            greater[:-1] |= gt & empty[1:]
+            greater[1:] |= lt & empty[:-1]
+            for val, excluded, which in (
+                (missing[-1], lesser, "largest"),
+                (missing[0], greater, "smallest"),
+            ):
+                before = cands[rs, cs, val - 1]
+                after = before & ~excluded
+                if before.sum() > 1 and after.sum() == 1:
+                    j = after.argmax()
+                    r, c = int(rs[j]), int(cs[j])
+                    yield r, c, val, self.suggestion(unit, val, which)
+
+    def suggestion(self, unit, val, which):
+        return f"Where in {unit} does the number {val} have to go, given it is the {which} number missing?"
+
+    def can_apply(self, grid, cands):
+        return True
+
+
+class ChainBoundRule:
+    """Inequalities limit the values a cell can take to those between the candidates
+    of its neighbours, which can leave only one value for a cell."""
+
+    def __init__(self):
+        self.name = "chain bounds"
+        self.exact = False
+
+    def apply(self, grid):
+        return next(self.iter_apply(grid), None)
+
+    def iter_apply(self, grid):
+        cands = grid.candidates()
+        for r, c, val in _new_singles(cands, _tighten_bounds(grid, cands)):
+            yield r, c, val, self.suggestion(r, c)
+
+    def suggestion(self, r, c):
+        return f"How do the inequalities narrow down the numbers that can go in row {r + 1}, column {c + 1}?"
+
+    def can_apply(self, grid, cands):
+        return np.any(grid.across != 0) or np.any(grid.down != 0)
+
+
+_SIZES = {2: ("pair", "two"), 3: ("triple", "three")}
+
+
+class NakedSubsetRule:
+    """A set of k cells in a row or column whose candidates are the same k values
+    between them must hold those values, so no other cell in the row or column
+    can."""
+
+    def __init__(self, size=2):
+        self.size = size
+        self.name = f"naked {_SIZES[size][0]}"
+        self.exact = False
+
+    def apply(self, grid):
+        return next(self.iter_apply(grid), None)
+
+    def iter_apply(self, grid):
+        cands = grid.candidates()
+        for unit, rs, cs, _ in _units(grid):
+            unit_cands = cands[rs, cs]
+            counts = unit_cands.sum(axis=-1)
+            cells = np.flatnonzero((counts >= 2) & (counts <= self.size))
+            for subset in itertools.combinations(cells, self.size):
+                vals = unit_cands[list(subset)].any(axis=0)
+                if vals.sum() != self.size:
+                    continue
+                others = np.setdiff1d(np.arange(grid.n), subset)
+                after = cands.copy()
+                after[rs[others], cs[others]] &= ~vals
+                for r, c, val in _new_singles(cands, after):
+                    yield r, c, val, self.suggestion(unit, r, c)
+
+    def suggestion(self, unit, r, c):
+        k = _SIZES[self.size][1]
+        return f"Which {k} cells in {unit} can only hold the same {k} numbers, and what does that leave for row {r + 1}, column {c + 1}?"
+
+    def can_apply(self, grid, cands):
+        return np.sum(grid.values == 0) > self.size
+
+
+class HiddenSubsetRule:
+    """A set of k values in a row or column that can only go in the same k cells
+    must fill those cells, so no other value can go in them."""
+
+    def __init__(self, size=2):
+        self.size = size
+        self.name = f"hidden {_SIZES[size][0]}"
+        self.exact = False
+
+    def apply(self, grid):
+        return next(self.iter_apply(grid), None)
+
+    def iter_apply(self, grid):
+        cands = grid.candidates()
+        for unit, rs, cs, _ in _units(grid):
+            unit_cands = cands[rs, cs]
+            counts = unit_cands.sum(axis=0)
+            vals = np.flatnonzero((counts >= 2) & (counts <= self.size))
+            for subset in itertools.combinations(vals, self.size):
+                cells = unit_cands[:, list(subset)].any(axis=1)
+                if cells.sum() != self.size:
+                    continue
+                others = np.ones(grid.n, dtype=bool)
+                others[list(subset)] = False
+                after = cands.copy()
+                after[rs[cells], cs[cells]] &= ~others
+                for r, c, val in _new_singles(cands, after):
+                    yield r, c, val, self.suggestion(unit, r, c)
+
+    def suggestion(self, unit, r, c):
+        k = _SIZES[self.size][1]
+        return f"Which {k} numbers in {unit} can only go in the same {k} cells, and what does that leave for row {r + 1}, column {c + 1}?"
+
+    def can_apply(self, grid, cands):
+        return np.sum(grid.values == 0) > self.size
+
 
 class MinimumRefutationScoreRule:
     """Find a cell that requires the fewest number of simple steps to demonstrate
     the inconsistency of each wrong candidate value."""
 
-    def __init__(self):
+    def __init__(self, ctx=None, scorer=None):
+        self.ctx = ctx
+        self.scorer = scorer
         self.name = "refutation"
+        self.exact = True
 
     def apply(self, grid):
-        scores = refutation_scores(grid)
+        if self.scorer is None:
+            scores = refutation_scores(grid, self.ctx)
+        else:
+            scores = self.scorer(grid)
         masked_scores = np.ma.masked_equal(scores, 0, copy=False)
         r, c = np.unravel_index(masked_scores.argmin(), scores.shape)
-        suggestion = f"Can you show that all but one number for row {r + 1}, column {c + 1} are impossible?"
-        return r, c, None, suggestion  # TODO: fill in value
+        return r, c, None, self.suggestion(r, c, None)  # TODO: fill in value
+
+    def iter_apply(self, grid):
+        if self.scorer is None:
+            scores = refutation_scores(grid, self.ctx)
+        else:
+            scores = self.scorer(grid)
+        # cells in order of increasing score
+        for i in np.argsort(scores, axis=None, kind="stable"):
+            r, c = np.unravel_index(i, scores.shape)
+            if scores[r, c] != 0:
+                yield int(r), int(c), None, self.suggestion(r, c, None)
+
+    def suggestion(self, r, c, val):
+        return f"Can you show that all but one number for row {r + 1}, column {c + 1} are impossible?"
 
+    def can_apply(self, grid, cands):
+        return True
 
-def hint(grid):
-    rules = (
-        RowAndColumnExclusionRule(),
-        RowInclusionRule(),
-        ColumnInclusionRule(),
-        MinimumRefutationScoreRule(),
+
+def default_rules(ctx=None):
+    """Return the rules used to find hints, in priority order."""
+    return (
+        RowAndColumnExclusionRule(ctx),
+        RowInclusionRule(ctx),
+        ColumnInclusionRule(ctx),
+        ChainEndRule(),
+        ChainBoundRule(),
+        NakedSubsetRule(2),
+        HiddenSubsetRule(2),
+        NakedSubsetRule(3),
+        HiddenSubsetRule(3),
+        MinimumRefutationScoreRule(ctx),
     )
+
+
+class RuleStats:
+    """How often a rule has been tried, and how often it has produced a hint."""
+
+    def __init__(self):
+        self.calls = 0
+        self.hits = 0
+        self.skipped = 0
+        self.seconds = 0.0
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.calls if self.calls > 0 else 0.0
+
+    @property
+    def mean_seconds(self):
+        return self.seconds / self.calls if self.calls > 0 else 0.0
+
+    def __repr__(self):
+        return (
+            f"RuleStats(calls={self.calls}, hits={self.hits}, "
+            f"skipped={self.skipped}, seconds={self.seconds:.3f})"
+        )
+
+
+class RuleScheduler:
+    """Apply rules in priority order to find a hint, keeping statistics on each rule.
+
+    The candidate values for a grid are computed once and shared by the rules.
+    Before a rule is applied, its `can_apply` method is called with the
+    candidates, and the rule is skipped if it provably can't produce a hint. The
+    first rule to produce a hint wins, so hints are the same as applying every
+    rule in turn.
+    """
+
+    def __init__(self, rules=None, ctx=None):
+        if rules is None:
+            rules = default_rules(ctx)
+        self.rules = tuple(rules)
+        self.stats = {rule.name: RuleStats() for rule in self.rules}
+
+    def hint(self, grid):
+        cands = grid.candidates()
+        for rule in self.rules:
+            stats = self.stats[rule.name]
+            start = time.perf_counter()
+            try:
+                if not rule.can_apply(grid, cands):
+                    stats.skipped += 1
+                    continue
+                stats.calls += 1
+                res = rule.apply(grid)
+            finally:
+                stats.seconds += time.perf_counter() - start
+            if res is not None:
+                stats.hits += 1
+                r, c, val, suggestion = res
+                return r, c, rule.name, suggestion
+
+
+def get_scheduler():
+    """Return the rule scheduler for the current thread, creating it on first use."""
+    scheduler = getattr(_contexts, "scheduler", None)
+    if scheduler is None:
+        scheduler = _contexts.scheduler = RuleScheduler()
+    return scheduler
+
+
+def hint(grid, ctx=None, scheduler=None):
+    if scheduler is None:
+        scheduler = get_scheduler() if ctx is None else RuleScheduler(ctx=ctx)
+    return scheduler.hint(grid)
+
+
+def hint_dict(grid):
+    """Return a hint for the grid as a dict that can be serialized to JSON."""
+    r, c, name, suggestion = hint(grid)
+    return {"row": int(r), "column": int(c), "rule": name, "suggestion": suggestion}
+
+
+def iter_hints(grid, rules=None):
+    """Yield a hint for each cell that the rules can fill, in rule priority order.
+
+    The candidate values for the grid are computed once and shared by all the
+    rules. A cell is only yielded for the first rule that fills it. Rules are
+    only applied as the hints are consumed, so stopping early avoids the cost
+    of the later rules, in particular the refutation rule, which yields the
+    remaining cells in order of increasing score.
+    """
+    rules = default_rules() if rules is None else rules
+    cands = grid.candidates()
+    seen = set()
     for rule in rules:
-        res = rule.apply(grid)
-        if res is not None:
-            r, c, val, suggestion = res
-            return r, c, rule.name, suggestion
+        if not rule.can_apply(grid, cands):
+            continue
+        for r, c, val, suggestion in rule.iter_apply(grid):
+            if (r, c) not in seen:
+                seen.add((r, c))
+                yield r, c, rule.name, suggestion
+
+
+def _race_rule(rules, i, grid, cancel, contexts):
+    if cancel.is_set():
+        raise Cancelled()
+    ctx = contexts[i] = Context(proof=True)
+    _contexts.cancel = cancel
+    try:
+        return rules(ctx)[i].apply(grid)
+    except Z3Exception:
+        # an interrupted context raises an exception from whichever Z3 call
+        # was running
+        if cancel.is_set():
+            raise Cancelled()
+        raise
+    finally:
+        _contexts.cancel = None
+
+
+def hint_concurrent(grid, executor=None, rules=default_rules):
+    """Return the same hint as `hint(grid)`, but try all the rules at once.
+
+    Each rule runs in its own thread with its own Z3 context. As soon as the
+    highest priority rule that can still succeed produces a hint, the rules
+    that are still running are cancelled and the hint is returned. Rules below
+    one that is certain to succeed are not started. `rules` is a function that
+    returns the rules in priority order for a given context. Refutation scores
+    depend on the history of their context, and `hint` computes them in a new
+    context too, so the hints agree.
+    """
+    # compute shared state once, before the threads use it
+    cands = grid.candidates()
+    grid.bounds()
+
+    own_executor = executor is None
+    priority = rules()
+    if own_executor:
+        executor = ThreadPoolExecutor(len(priority))
+    cancel = threading.Event()
+    contexts = {}
+    futures = []
+    try:
+        for i, rule in enumerate(priority):
+            if rule.can_apply(grid, cands):
+                future = executor.submit(_race_rule, rules, i, grid, cancel, contexts)
+            else:
+                future = None
+            futures.append(future)
+            if future is not None and rule.exact:
+                # no lower priority rule can be needed
+                break
+        for rule, future in zip(priority, futures):
+            res = None if future is None else future.result()
+            if res is not None:
+                r, c, val, suggestion = res
+                return r, c, rule.name, suggestion
+        return None
+    finally:
+        # stop any lower priority rules that are still queued or running
+        cancel.set()
+        for future in futures:
+            if future is not None:
+                future.cancel()
+        for ctx in list(contexts.values()):
+            ctx.interrupt()
+        if own_executor:
+            # the cancelled rules stop at their next Z3 call, so this is quick,
+            # and none of their work is counted after this returns
+            executor.shutdown(wait=True)
+
+
+def candidates(values, across, down):
+    """Return a boolean array of shape (..., n, n, n) whose element [..., r, c, v - 1]
+    is True if the value v can go in the empty cell (r, c).
+
+    A value can go in a cell if setting it would leave the grid consistent, as
+    decided by `is_consistent`. Leading dimensions of the arrays are treated as
+    a batch of grids of the same size.
+    """
+    values = np.asarray(values, dtype=int)
+    n = values.shape[-1]
+    vals = np.arange(1, n + 1)
+    filled = values != 0
+
+    lo, hi = _chain_bounds(
+        np.where(filled, values, 1), np.where(filled, values, n), across, down
+    )
+    in_bounds = (lo[..., np.newaxis] <= vals) & (vals <= hi[..., np.newaxis])
+
+    # values already in the row or column of each cell
+    onehot = values[..., np.newaxis] == vals
+    used = onehot.any(axis=-2)[..., :, np.newaxis, :]
+    used = used | onehot.any(axis=-3)[..., np.newaxis, :, :]
+
+    cands = in_bounds & ~used & ~filled[..., np.newaxis]
+
+    # nothing can go in a grid that is already inconsistent
+    consistent = np.all(lo <= hi, axis=(-2, -1))
+    consistent &= np.all(values <= n, axis=(-2, -1))
+    consistent &= np.all(onehot.sum(axis=-2) <= 1, axis=(-2, -1))
+    consistent &= np.all(onehot.sum(axis=-3) <= 1, axis=(-2, -1))
+    return cands & consistent[..., np.newaxis, np.newaxis, np.newaxis]
+
+
+def _first(mask):
+    """Return the row-major index of the first True element of each (n, n) mask
+    in a batch, and whether there is one."""
+    flat = mask.reshape(mask.shape[0], -1)
+    return np.unravel_index(flat.argmax(axis=1), mask.shape[1:]), flat.any(axis=1)
+
+
+def hint_batch(grids, ctx=None):
+    """Return the hint for each of a sequence of grids of the same size.
+
+    This is equivalent to calling `hint` on each grid, but the exclusion and
+    inclusion rules are applied to all the grids at once using a stacked array
+    of candidate values. Only the grids that need the other rules are tried one
+    by one.
+    """
+    grids = list(grids)
+    if len(grids) == 0:
+        return []
+    if len({grid.n for grid in grids}) > 1:
+        raise ValueError("All grids in a batch must be the same size")
+
+    values = np.stack([grid.values for grid in grids])
+    across = np.stack([grid.across for grid in grids])
+    down = np.stack([grid.down for grid in grids])
+    cands = candidates(values, across, down)  # (K, r, c, v)
+    counts = cands.sum(axis=-1)
+
+    rules = default_rules(ctx)
+    exclusion, row_inclusion, column_inclusion = rules[:3]
+    results = [None] * len(grids)
+
+    def fill(rule, rs, cs, vs, found):
+        for k in np.flatnonzero(found):
+            if results[k] is None:
+                r, c, val = int(rs[k]), int(cs[k]), int(vs[k]) + 1
+                results[k] = r, c, rule.name, rule.suggestion(r, c, val)
+
+    # exclusion: the first cell with a single candidate
+    (rs, cs), found = _first((counts == 1) & (values == 0))
+    vs = cands[np.arange(len(grids)), rs, cs].argmax(axis=-1)
+    fill(exclusion, rs, cs, vs, found)
+
+    # row inclusion: the first (row, value) with a single candidate cell
+    (rs, vs), found = _first(cands.sum(axis=2) == 1)
+    cs = cands[np.arange(len(grids)), rs, :, vs].argmax(axis=-1)
+    fill(row_inclusion, rs, cs, vs, found)
+
+    # column inclusion: the first (column, value) with a single candidate cell
+    (cs, vs), found = _first(cands.sum(axis=1) == 1)
+    rs = cands[np.arange(len(grids)), :, cs, vs].argmax(axis=-1)
+    fill(column_inclusion, rs, cs, vs, found)
+
+    # fall back to the remaining rules for each grid without a hint
+    scheduler = RuleScheduler(rules[3:])
+    for k, grid in enumerate(grids):
+        if results[k] is None:
+            results[k] = scheduler.hint(grid)
+    return results
 
 
 def play(grid, n_moves=5):
@@ -0,0 +1,97 @@
+import json
+import os
+import sys
+
+from futoshiki import *
+from puzzles import *
+
+# Solver constructions, checks and grid copies are deterministic, unlike wall
+# time, so they are used to catch performance regressions. Run
+# ``python perf.py --update`` to deliberately refresh the baseline.
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "perf_baseline.json")
+
+EVENTS = ("solver", "check", "copy")
+
+# grids from the tests, by name
+TEST_GRIDS = {
+    "exclusion": EXCLUSION,
+    "krazydad_4x4_1_1_3": KRAZYDAD_4X4_1_1_3,
+    "row_inclusion": ROW_INCLUSION,
+    "column_inclusion": COLUMN_INCLUSION,
+    "guardian_2021_01_16": GUARDIAN_2021_01_16,
+    "chain_end": CHAIN_END,
+    "chain_bounds": CHAIN_BOUNDS,
+    "refutation": REFUTATION,
+}
+
+# grids whose refutation scores are measured directly, as well as their hints
+REFUTATION_GRIDS = ("guardian_2021_01_16",)
+
+
+def grids():
+    res = {name: Grid(rep) for name, rep in TEST_GRIDS.items()}
+    seen = {str(grid) for grid in res.values()}
+    for i, rep in enumerate(README):
+        # some of the README puzzles are also test grids
+        grid = Grid(rep)
+        if str(grid) not in seen:
+            res[f"readme_{i + 1}"] = grid
+    return res
+
+
+def measure():
+    """Return the counts of each event for a hint on each grid, and for the
+    refutation scores of some of them."""
+    res = {}
+
+    def record(name, fn, grid):
+        with counting() as counts:
+            fn(grid)
+        res[name] = {event: counts[event] for event in EVENTS}
+
+    all_grids = grids()
+    for name, grid in all_grids.items():
+        record(name, lambda grid: hint(grid, scheduler=RuleScheduler()), grid)
+    for name in REFUTATION_GRIDS:
+        grid = all_grids[name]
+        # the incremental mode isn't measured, since the candidates it skips
+        # depend on the models Z3 finds, which can change between versions
+        record(f"{name} refutation_scores", refutation_scores, grid)
+    return res
+
+
+def load_baseline(path=BASELINE_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(counts, path=BASELINE_PATH):
+    with open(path, "w") as f:
+        json.dump(counts, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def over_budget(counts, baseline):
+    """Return a list of the counts that are higher than the baseline."""
+    failures = []
+    for name, events in counts.items():
+        for event, count in events.items():
+            budget = baseline.get(name, {}).get(event, 0)
+            if count > budget:
+                failures.append(f"{name}: {event} {count} > {budget}")
+    return failures
+
+
+if __name__ == "__main__":
+    counts = measure()
+    if "--update" in sys.argv[1:]:
+        save_baseline(counts)
+        print(f"Updated {BASELINE_PATH}")
+    else:
+        for name, events in counts.items():
+            print(name, events)
+        failures = over_budget(counts, load_baseline())
+        for failure in failures:
+            print(failure)
+        sys.exit(1 if failures else 0)
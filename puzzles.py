@@ -0,0 +1,121 @@
+# Puzzles shared by the tests, the benchmarks and the performance gate, in the
+# text format used by `Grid`.
+
+# from https://krazydad.com/tablet/futoshiki/?kind=4x4&volumeNumber=1&bookNumber=1&puzzleNumber=3
+KRAZYDAD_4X4_1_1_3 = """
+·   ·   ·   ·
+
+·   ·   ·   ·
+^
+2   ·   ·   ·
+    ^
+·   ·   ·   4
+"""
+
+# from https://www.futoshiki.org/how-to-solve
+FUTOSHIKI_ORG = """
+3   ·   · > ·
+    v
+·   ·   ·   ·
+
+·   ·   ·   ·
+        ^
+· > ·   ·   ·
+"""
+
+# Krazydad Volume 1, Book 100, #16
+KRAZYDAD_5X5_1_100_16 = """
+·   ·   ·   ·   ·
+^
+· < ·   1   · > ·
+^               v
+·   · > ·   ·   1
+v           v
+·   ·   ·   · > ·
+
+·   ·   ·   ·   ·
+"""
+
+EXCLUSION = """
+3   ·   1   2
+
+·   ·   2   ·
+
+·   ·   ·   3
+
+1   ·   ·   4
+"""
+
+# based on https://www.futoshiki.org/how-to-solve
+ROW_INCLUSION = """
+3   ·   · > ·
+    v
+·   ·   3   ·
+
+·   ·   ·   ·
+        ^
+· > ·   ·   ·
+"""
+
+COLUMN_INCLUSION = """
+·   ·   4   ·
+v
+·   4 > ·   ·
+
+·   · < · < 4
+
+4   ·   · < 3
+"""
+
+GUARDIAN_2021_01_16 = """
+· < ·   ·   · > ·
+    ^       v
+·   · < ·   ·   ·
+    ^
+· < ·   ·   ·   ·
+^               v
+·   · < ·   ·   ·
+^       ^
+· < ·   · > · > ·
+"""
+
+# none of the simple rules apply to the following grids, so the intermediate
+# rules and the refutation rule are all tried
+CHAIN_END = """
+·   · > 2   1   ·
+    v       ^
+1 < ·   5 > 4   ·
+^               v
+5   · < 4   3   ·
+v
+·   ·   1   ·   ·
+^       ^
+·   · < 3   ·   ·
+"""
+
+CHAIN_BOUNDS = """
+·   1   ·   2   ·
+    ^   ^
+·   ·   ·   ·   ·
+        v       ^
+·   · > ·   ·   ·
+v   v       ^
+· < ·   ·   ·   2
+    v
+·   · < ·   ·   ·
+"""
+
+REFUTATION = """
+·   ·   ·   2   ·
+    ^   ^
+·   ·   ·   ·   ·
+        v       ^
+·   · > ·   ·   ·
+v   v       ^
+· < ·   ·   ·   2
+    v
+·   · < ·   ·   ·
+"""
+
+# the puzzles from the README
+README = [KRAZYDAD_4X4_1_1_3, FUTOSHIKI_ORG, KRAZYDAD_5X5_1_100_16]
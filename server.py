@@ -0,0 +1,198 @@
+import bisect
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from futoshiki import *
+
+
+def _solve(grid):
+    solution = solve(grid)
+    return {"grid": None if solution is None else str(solution)}
+
+
+def _refutation_scores(grid):
+    return {"scores": refutation_scores(grid).tolist()}
+
+
+ENDPOINTS = {
+    "/hint": hint_dict,
+    "/solve": _solve,
+    "/refutation_scores": _refutation_scores,
+}
+
+
+class Overloaded(Exception):
+    """Raised when there are too many requests waiting to be served."""
+
+
+class ShutDown(Exception):
+    """Raised when a request is made after the service has been shut down."""
+
+
+class Histogram:
+    """A latency histogram with fixed bucket boundaries, in seconds."""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def to_dict(self):
+        buckets = {str(le): n for le, n in zip(self.BUCKETS, self.counts)}
+        buckets["inf"] = self.counts[-1]
+        return {"count": self.count, "sum": self.total, "buckets": buckets}
+
+
+def _warm_up():
+    # create this worker's Z3 context and pay Z3's startup cost before serving
+    solve(Grid.empty(2))
+
+
+class HintService:
+    """Serve hints from a pool of warm worker threads.
+
+    At most `max_pending` distinct requests can be queued or running at once,
+    beyond which `submit` raises `Overloaded`. Identical requests for the same
+    grid that arrive while one is in flight share its result. After `shutdown`,
+    `submit` raises `ShutDown`.
+    """
+
+    def __init__(self, workers=4, max_pending=64):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(workers, initializer=_warm_up)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.histograms = {endpoint: Histogram() for endpoint in ENDPOINTS}
+        self.counters = {"requests": 0, "coalesced": 0, "rejected": 0, "errors": 0}
+
+        # start all the workers now, rather than on the first requests
+        barrier = threading.Barrier(workers)
+        for f in [self.executor.submit(barrier.wait) for _ in range(workers)]:
+            f.result()
+
+    def submit(self, endpoint, rep):
+        """Return a future for the result of calling `endpoint` on a grid."""
+        fn = ENDPOINTS[endpoint]
+        grid = Grid(rep)
+        key = endpoint, str(grid)
+        with self.lock:
+            self.counters["requests"] += 1
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.counters["coalesced"] += 1
+                return future
+            if len(self.in_flight) >= self.max_pending:
+                self.counters["rejected"] += 1
+                raise Overloaded()
+            try:
+                future = self.executor.submit(self._run, endpoint, fn, grid)
+            except RuntimeError:
+                # the executor has been shut down
+                raise ShutDown()
+            self.in_flight[key] = future
+        future.add_done_callback(lambda _: self._done(key))
+        return future
+
+    def _run(self, endpoint, fn, grid):
+        start = time.perf_counter()
+        try:
+            return fn(grid)
+        except Exception:
+            with self.lock:
+                self.counters["errors"] += 1
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.histograms[endpoint].observe(seconds)
+
+    def _done(self, key):
+        with self.lock:
+            self.in_flight.pop(key, None)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "in_flight": len(self.in_flight),
+                "latency": {e: h.to_dict() for e, h in self.histograms.items()},
+            }
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Handle JSON requests of the form {"grid": "<text representation>"}."""
+
+    service = None  # set by make_server
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_json(200, self.service.metrics())
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path not in ENDPOINTS:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            rep = json.loads(self.rfile.read(length))["grid"]
+            future = self.service.submit(self.path, rep)
+        except Overloaded:
+            self.send_json(503, {"error": "Too many requests"}, {"Retry-After": "1"})
+            return
+        except ShutDown:
+            self.send_json(503, {"error": "The service is shutting down"})
+            return
+        except Exception as e:
+            self.send_json(400, {"error": f"Bad request: {e}"})
+            return
+        try:
+            self.send_json(200, future.result())
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+
+    def send_json(self, status, obj, headers=None):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host="127.0.0.1", port=8000, service=None):
+    """Return an HTTP server for a hint service. Use port 0 for any free port."""
+    handler = type("Handler", (Handler,), {"service": service or HintService()})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    server = make_server(port=port)
+    print(f"Serving hints on http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.RequestHandlerClass.service.shutdown()
@@ -1,6 +1,9 @@
 import numpy as np
+import pytest
 from numpy.testing import assert_array_equal
 from futoshiki import *
+from puzzles import *
+from z3 import Z3Exception
 
 blank = """
 ·   ·   ·   ·
@@ -166,15 +169,7 @@ v
 
 
 def test_exclusion_rule():
-    rep = """
-3   ·   1   2
-             
-·   ·   2   ·
-             
-·   ·   ·   3
-             
-1   ·   ·   4
-"""
+    rep = EXCLUSION
     grid = Grid(rep)
     rule = RowAndColumnExclusionRule()
     assert rule.apply(grid, 1, 1) is None
@@ -197,15 +192,7 @@ def test_exclusion_rule():
         "What is the only value that can go in row 2, column 4?",
     )
 
-    rep = """
-·   ·   ·   ·
-             
-·   ·   ·   ·
-^            
-2   ·   ·   ·
-    ^        
-·   ·   ·   4
-"""
+    rep = KRAZYDAD_4X4_1_1_3
     grid = Grid(rep)
     rule = RowAndColumnExclusionRule()
     suggestion = "What is the only value that can go in row 2, column 1?"
@@ -214,15 +201,7 @@ def test_exclusion_rule():
 
 def test_inclusion_rule():
     # based on https://www.futoshiki.org/how-to-solve
-    rep = """
-3   ·   · > ·
-    v        
-·   ·   ·   ·
-             
-·   ·   ·   ·
-        ^    
-· > ·   ·   ·
-"""
+    rep = FUTOSHIKI_ORG
     grid = Grid(rep)
     rule = RowInclusionRule()
     suggestion = "Where in row 1 does the number 1 have to go?"
@@ -244,17 +223,7 @@ v
 
 
 def test_refutation_score_guardian_2021_01_16():
-    rep = """
-· < ·   ·   · > ·
-    ^       v    
-·   · < ·   ·   ·
-    ^        
-· < ·   ·   ·   ·
-^               v
-·   · < ·   ·   ·
-^       ^        
-· < ·   · > · > ·
-"""
+    rep = GUARDIAN_2021_01_16
     grid = Grid(rep)
     rule = MinimumRefutationScoreRule()
     suggestion = (
@@ -264,15 +233,7 @@ def test_refutation_score_guardian_2021_01_16():
 
 
 def test_solve():
-    rep = """
-·   ·   ·   ·
-             
-·   ·   ·   ·
-^            
-2   ·   ·   ·
-    ^        
-·   ·   ·   4
-"""
+    rep = KRAZYDAD_4X4_1_1_3
     grid = Grid(rep)
     solution = solve(grid)
     assert_array_equal(
@@ -291,15 +252,7 @@ def test_solve():
 def test_hint():
     # from https://krazydad.com/tablet/futoshiki/?kind=4x4&volumeNumber=1&bookNumber=1&puzzleNumber=3
 
-    rep = """
-·   ·   ·   ·
-             
-·   ·   ·   ·
-^            
-2   ·   ·   ·
-    ^        
-·   ·   ·   4
-"""
+    rep = KRAZYDAD_4X4_1_1_3
     grid = Grid(rep)
     r, c, name, suggestion = hint(grid)
     assert r == 1
@@ -354,15 +307,7 @@ def test_hint():
 
 def test_hint_inclusion():
     # from https://www.futoshiki.org/how-to-solve
-    rep = """
-3   ·   · > ·
-    v        
-·   ·   3   ·
-             
-·   ·   ·   ·
-        ^    
-· > ·   ·   ·
-"""
+    rep = ROW_INCLUSION
     grid = Grid(rep)
     r, c, name, suggestion = hint(grid)
     assert r == 0
@@ -371,17 +316,7 @@ def test_hint_inclusion():
 
 
 def test_hint_inclusion_guardian_2021_01_16():
-    rep = """
-· < ·   ·   · > ·
-    ^       v    
-·   · < ·   ·   ·
-    ^        
-· < ·   ·   ·   ·
-^               v
-·   · < ·   ·   ·
-^       ^        
-· < ·   · > · > ·
-"""
+    rep = GUARDIAN_2021_01_16
     grid = Grid(rep)
     r, c, name, suggestion = hint(grid)
     assert r == 3
@@ -391,17 +326,630 @@ def test_hint_inclusion_guardian_2021_01_16():
 
 def test_hint_inclusion_iterating_possibilities():
     # from https://www.futoshiki.org/how-to-solve
+    rep = COLUMN_INCLUSION
+    grid = Grid(rep)
+    r, c, name, suggestion = hint(grid)
+    assert r == 0
+    assert c == 1
+    assert name == "column inclusion"
+
+
+def test_precheck_avoids_z3():
+    stats.clear()
+    grid = Grid(
+        """
+1 > ·
+     
+·   ·
+"""
+    )
+    assert is_consistent(grid) == False
+    assert stats["z3_calls_avoided"] == 1
+
+    # a chain needs Z3 to spot the inconsistency
+    grid = Grid(
+        """
+2 > · > ·
+         
+·   ·   ·
+         
+·   ·   ·
+"""
+    )
+    assert is_consistent(grid) == False
+    assert stats["z3_calls_avoided"] == 1
+
+
+def test_chain_bounds():
+    rep = """
+· < · < ·   ·
+             
+·   ·   ·   ·
+        v    
+·   ·   3   ·
+             
+·   ·   ·   ·
+"""
+    grid = Grid(rep)
+    assert_array_equal(grid.chains.lower[0, :3], [1, 2, 3])
+    assert_array_equal(grid.chains.upper[0, :3], [2, 3, 4])
+    lo, hi = grid.bounds()
+    assert (lo[1, 2], hi[1, 2]) == (4, 4)
+    assert (lo[2, 2], hi[2, 2]) == (3, 3)
+
+    # the index is shared when values are set
+    assert grid.set(3, 3, 1).chains is grid.chains
+
+
+def test_hint_batch():
+    reps = [
+        KRAZYDAD_4X4_1_1_3,
+        ROW_INCLUSION,
+        COLUMN_INCLUSION,
+    ]
+    grids = [Grid(rep) for rep in reps]
+    assert hint_batch(grids) == [hint(grid) for grid in grids]
+
+
+def test_hint_threads():
+    from concurrent.futures import ThreadPoolExecutor
+
+    reps = [
+        """
+·   ·   ·   ·
+             
+1   ·   ·   ·
+^            
+2   ·   ·   ·
+    ^        
+·   ·   ·   4
+""",
+        ROW_INCLUSION,
+        COLUMN_INCLUSION,
+    ]
+    grids = [Grid(rep) for rep in reps] * 2
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = list(executor.map(hint, grids))
+    assert results == [hint(grid) for grid in grids]
+    assert get_context() is get_context()
+
+
+def test_server():
+    import json
+    import threading
+    import urllib.request
+
+    from server import HintService, make_server
+
+    rep = ROW_INCLUSION
+    service = HintService(workers=1)
+    server = make_server(port=0, service=service)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        request = urllib.request.Request(
+            url + "/hint",
+            data=json.dumps({"grid": rep}).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request) as response:
+            assert json.load(response) == {
+                "row": 0,
+                "column": 3,
+                "rule": "row inclusion",
+                "suggestion": "Where in row 1 does the number 1 have to go?",
+            }
+
+        # identical requests in flight share a result, so keep the only
+        # worker busy until both have been submitted
+        release = threading.Event()
+        blocker = service.executor.submit(release.wait)
+        f1 = service.submit("/solve", rep)
+        f2 = service.submit("/solve", rep)
+        release.set()
+        blocker.result()
+        assert f1 is f2
+        assert f1.result()["grid"] is not None
+
+        with urllib.request.urlopen(url + "/metrics") as response:
+            metrics = json.load(response)
+        assert metrics["requests"] == 3
+        assert metrics["coalesced"] == 1
+        assert metrics["latency"]["/hint"]["count"] == 1
+    finally:
+        server.shutdown()
+        thread.join()
+        service.shutdown()
+
+
+def test_server_overloaded():
+    import json
+    import threading
+    import urllib.error
+    import urllib.request
+
+    from server import HintService, make_server
+
+    service = HintService(workers=1, max_pending=1)
+    server = make_server(port=0, service=service)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    release = threading.Event()
+    try:
+        # the only worker is busy and the only pending slot is taken
+        service.executor.submit(release.wait)
+        pending = service.submit("/solve", EXCLUSION)
+
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        request = urllib.request.Request(
+            url + "/hint",
+            data=json.dumps({"grid": ROW_INCLUSION}).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            urllib.request.urlopen(request)
+            assert False, "expected the request to be rejected"
+        except urllib.error.HTTPError as e:
+            assert e.code == 503
+            assert e.headers["Retry-After"] == "1"
+
+        release.set()
+        pending.result()
+        assert service.metrics()["rejected"] == 1
+    finally:
+        release.set()
+        server.shutdown()
+        thread.join()
+        service.shutdown()
+
+
+def test_server_shut_down():
+    import json
+    import threading
+    import urllib.error
+    import urllib.request
+
+    from server import HintService, make_server
+
+    service = HintService(workers=1)
+    server = make_server(port=0, service=service)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        service.shutdown()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        request = urllib.request.Request(
+            url + "/hint",
+            data=json.dumps({"grid": ROW_INCLUSION}).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            urllib.request.urlopen(request)
+            assert False, "expected the request to be rejected"
+        except urllib.error.HTTPError as e:
+            assert e.code == 503
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def test_rule_scheduler():
+    rep = ROW_INCLUSION
+    grid = Grid(rep)
+    scheduler = RuleScheduler()
+    r, c, name, suggestion = hint(grid, scheduler=scheduler)
+    assert (r, c, name) == (0, 3, "row inclusion")
+    # the exclusion rule can't fire on this grid, so it isn't tried
+    assert scheduler.stats["exclusion"].skipped == 1
+    assert scheduler.stats["exclusion"].calls == 0
+    assert scheduler.stats["row inclusion"].hits == 1
+    assert scheduler.stats["column inclusion"].calls == 0
+
+
+def test_candidates_match_is_consistent():
+    # the simple rules use the candidates instead of calling Z3 for each value
+    for rep in [KRAZYDAD_4X4_1_1_3, ROW_INCLUSION, COLUMN_INCLUSION, CHAIN_END]:
+        grid = Grid(rep)
+        cands = grid.candidates()
+        for r, c in np.argwhere(grid.values == 0):
+            for val in range(1, grid.n + 1):
+                expected = is_consistent(grid.set(r, c, val))
+                assert cands[r, c, val - 1] == expected
+
+
+def test_chain_end_rule():
+    rep = """
+4   2   · < ·
+             
+·   ·   ·   ·
+             
+·   ·   ·   ·
+             
+·   ·   ·   ·
+"""
+    grid = Grid(rep)
+    rule = ChainEndRule()
+    suggestion = "Where in row 1 does the number 3 have to go, given it is the largest number missing?"
+    assert rule.apply(grid) == (0, 3, 3, suggestion)
+
+
+def test_chain_bound_rule():
     rep = """
+· < ·   ·   ·
+             
+·   4   ·   ·
+             
+·   3   ·   ·
+             
+·   ·   ·   ·
+"""
+    grid = Grid(rep)
+    rule = ChainBoundRule()
+    suggestion = "How do the inequalities narrow down the numbers that can go in row 1, column 1?"
+    assert rule.apply(grid) == (0, 0, 1, suggestion)
+
+
+def test_naked_subset_rule():
+    rep = """
+·   ·   ·   ·
+             
+3   4   ·   ·
+             
+4   3   ·   ·
+             
 ·   ·   4   ·
+"""
+    grid = Grid(rep)
+    rule = NakedSubsetRule(2)
+    suggestion = "Which two cells in row 1 can only hold the same two numbers, and what does that leave for row 1, column 3?"
+    assert rule.apply(grid) == (0, 2, 3, suggestion)
+
+    rep = """
+·   · < · > ·
+v   ^   v    
+·   · > · < ·
+v       ^    
+·   ·   4   ·
+^   v        
+·   ·   ·   ·
+"""
+    grid = Grid(rep)
+    rule = NakedSubsetRule(3)
+    suggestion = "Which three cells in row 1 can only hold the same three numbers, and what does that leave for row 1, column 1?"
+    assert rule.apply(grid) == (0, 0, 4, suggestion)
+
+
+def test_hidden_subset_rule():
+    rep = """
+·   2   ·   ·
+    ^        
+·   · < ·   ·
+            ^
+3   1   ·   ·
 v            
-·   4 > ·   ·
+· < · > ·   3
+"""
+    grid = Grid(rep)
+    rule = HiddenSubsetRule(2)
+    suggestion = "Which two numbers in row 2 can only go in the same two cells, and what does that leave for row 2, column 3?"
+    assert rule.apply(grid) == (1, 2, 4, suggestion)
+
+    rep = """
+·   ·   ·   ·
              
-·   · < · < 4
+· > 1 < ·   ·
              
-4   ·   · < 3
+· > ·   ·   1
+             
+·   3   4 > 2
 """
     grid = Grid(rep)
-    r, c, name, suggestion = hint(grid)
-    assert r == 0
-    assert c == 1
-    assert name == "column inclusion"
+    rule = HiddenSubsetRule(3)
+    suggestion = "Which three numbers in column 1 can only go in the same three cells, and what does that leave for row 1, column 3?"
+    assert rule.apply(grid) == (0, 2, 1, suggestion)
+
+
+def test_propagation_scores():
+    # Krazydad Volume 1, Book 100, #16 from the README
+    rep = KRAZYDAD_5X5_1_100_16
+    grid = Grid(rep)
+    scores = propagation_scores(grid)
+    assert np.all((scores == 0) == (grid.values != 0))
+    rule = MinimumRefutationScoreRule(scorer=propagation_scores)
+    suggestion = (
+        "Can you show that all but one number for row 3, column 3 are impossible?"
+    )
+    assert rule.apply(grid) == (2, 2, None, suggestion)
+
+
+def test_corpus(tmp_path):
+    from corpus import Corpus, iter_corpus, read_text, text_to_binary, write_text
+
+    reps = [
+        KRAZYDAD_4X4_1_1_3,
+        ROW_INCLUSION,
+        COLUMN_INCLUSION,
+    ]
+    text = tmp_path / "corpus.txt"
+    binary = tmp_path / "corpus.fut"
+    write_text(text, [Grid(rep) for rep in reps])
+    assert [str(grid) for grid in read_text(text)] == [str(Grid(rep)) for rep in reps]
+
+    text_to_binary(text, binary)
+    corpus = Corpus(binary)
+    assert len(corpus) == 3
+    assert str(corpus[1]) == str(Grid(reps[1]))
+    assert np.shares_memory(corpus[1].values, corpus.records)
+    assert hint(corpus[2]) == hint(Grid(reps[2]))
+
+    # shards split at arbitrary byte offsets cover every grid exactly once
+    size = binary.stat().st_size
+    shards = [iter_corpus(binary, start, start + 20) for start in range(0, size, 20)]
+    assert [str(grid) for shard in shards for grid in shard] == [
+        str(grid) for grid in corpus
+    ]
+
+
+def test_corpus_copy_on_write_and_truncation(tmp_path):
+    from corpus import Corpus, iter_corpus, write_corpus
+
+    path = tmp_path / "corpus.fut"
+    write_corpus(path, [Grid(KRAZYDAD_4X4_1_1_3), Grid(ROW_INCLUSION)])
+    data = path.read_bytes()
+
+    # grids can be changed in place without changing the file
+    grid = Corpus(path)[0]
+    grid.values[0, 0] = 4
+    assert Corpus(path)[0].values[0, 0] == 0
+    assert path.read_bytes() == data
+
+    # a partial record at the end is reported, rather than failing to reshape
+    path.write_bytes(data[:-3])
+    with pytest.raises(ValueError, match="Truncated corpus"):
+        Corpus(path)
+    with pytest.raises(ValueError, match="Truncated corpus"):
+        list(iter_corpus(path))
+
+
+def test_batch_run(tmp_path):
+    from batch import DONE, read_results, run, slowest
+
+    grids = [Grid.empty(3).set(0, 0, val) for val in (1, 2, 3)]
+    results_path = str(tmp_path / "results.jsonl")
+    calls = []
+
+    def task(grid):
+        calls.append(int(grid.values[0, 0]))
+        if len(calls) == 2:
+            raise RuntimeError("worker failed")
+        return solve(grid).values.tolist()
+
+    assert run(grids, results_path, task) == 3
+    records = read_results(results_path)
+    assert [r["status"] for r in records] == ["ok", "error", "ok"]
+
+    # only the failed grid is run again
+    assert run(grids, results_path, task) == 1
+    assert calls == [1, 2, 3, 2]
+    with open(results_path + ".index", "rb") as f:
+        assert list(f.read()) == [DONE, DONE, DONE]
+    assert run(grids, results_path, task) == 0
+
+    assert len(slowest(results_path, k=2)) == 2
+
+
+def test_batch_resume_after_partial_write(tmp_path):
+    from batch import read_results, run
+
+    grids = [Grid.empty(3).set(0, 0, val) for val in (1, 2, 3)]
+    results_path = str(tmp_path / "results.jsonl")
+    assert run(grids, results_path, task=lambda grid: 0, indices=[0]) == 1
+
+    # simulate a crash while the second record was being written
+    with open(results_path, "a", encoding="utf-8") as f:
+        f.write('{"index": 1, "attem')
+    with open(results_path + ".index", "r+b") as f:
+        f.seek(1)
+        f.write(bytes([1]))
+
+    assert run(grids, results_path, task=lambda grid: 0) == 2
+    records = read_results(results_path)
+    assert [r["index"] for r in records] == [0, 1, 2]
+    assert all(r["status"] == "ok" for r in records)
+
+    # a bad line in the middle doesn't hide the records after it
+    with open(results_path, encoding="utf-8") as f:
+        lines = f.readlines()
+    lines.insert(1, "{not json\n")
+    with open(results_path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    assert [r["index"] for r in read_results(results_path)] == [0, 1, 2]
+
+
+def test_perf_budget():
+    # if this fails after a deliberate change, run python perf.py --update
+    from perf import load_baseline, measure, over_budget
+
+    assert over_budget(measure(), load_baseline()) == []
+
+
+def test_counting():
+    grid = Grid.empty(3)
+    with counting() as counts:
+        solve(grid.set(0, 0, 1))
+    assert counts["solver"] == 1
+    assert counts["check"] == 1
+    assert counts["copy"] == 1
+
+
+def test_hint_concurrent():
+    reps = [
+        """
+·   ·   ·   ·
+             
+1   ·   ·   ·
+^            
+2   ·   ·   ·
+    ^        
+3   ·   ·   4
+""",
+        COLUMN_INCLUSION,
+        GUARDIAN_2021_01_16,
+    ]
+    for rep in reps:
+        grid = Grid(rep)
+        assert hint_concurrent(grid) == hint(grid)
+
+
+class WrappedRule:
+    """A rule that runs functions before and after the rule it wraps."""
+
+    def __init__(self, rule, before=None, after=None):
+        self.rule = rule
+        self.name = rule.name
+        self.exact = rule.exact
+        self.before = before
+        self.after = after
+
+    def can_apply(self, grid, cands):
+        return self.rule.can_apply(grid, cands)
+
+    def apply(self, grid):
+        if self.before is not None:
+            self.before()
+        try:
+            res = self.rule.apply(grid)
+        except (Cancelled, Z3Exception):
+            res = "cancelled"
+            raise
+        finally:
+            if self.after is not None:
+                self.after(res)
+        return res
+
+
+def test_hint_concurrent_races_rules():
+    for rep, name in [
+        (CHAIN_END, "chain end"),
+        (CHAIN_BOUNDS, "chain bounds"),
+        (REFUTATION, "refutation"),
+    ]:
+        grid = Grid(rep)
+        res = hint_concurrent(grid)
+        assert res == hint(grid)
+        assert res[2] == name
+
+
+def test_hint_concurrent_cancels_lower_priority_rules():
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    grid = Grid(CHAIN_END)
+    refutation_started = threading.Event()
+    outcomes = []
+
+    def rules(ctx=None):
+        rules = list(default_rules(ctx))
+        # the chain end rule only returns once the refutation rule is running
+        rules[3] = WrappedRule(rules[3], before=lambda: refutation_started.wait(10))
+        rules[-1] = WrappedRule(
+            rules[-1], before=refutation_started.set, after=outcomes.append
+        )
+        return rules
+
+    executor = ThreadPoolExecutor(len(default_rules()))
+    try:
+        assert hint_concurrent(grid, executor, rules) == hint(grid)
+    finally:
+        executor.shutdown(wait=True)
+    assert outcomes == ["cancelled"]
+
+
+def test_hint_concurrent_stops_its_workers():
+    import threading
+
+    # cancelled rules have finished by the time the hint is returned, so they
+    # can't add to the counts of a later block
+    threads = threading.active_count()
+    assert hint_concurrent(Grid(CHAIN_END)) == hint(Grid(CHAIN_END))
+    assert threading.active_count() == threads
+
+
+def test_hint_concurrent_waits_for_higher_priority_rules():
+    import threading
+
+    grid = Grid(CHAIN_BOUNDS)
+    refutation_finished = threading.Event()
+
+    def rules(ctx=None):
+        rules = list(default_rules(ctx))
+        # the chain bounds rule only returns after the refutation rule has
+        # found its hint, but it has priority
+        rules[4] = WrappedRule(rules[4], before=lambda: refutation_finished.wait(10))
+        rules[-1] = WrappedRule(rules[-1], after=lambda res: refutation_finished.set())
+        return rules
+
+    assert hint_concurrent(grid, rules=rules) == hint(grid)
+    assert refutation_finished.is_set()
+
+
+def test_iter_hints():
+    # Krazydad Volume 1, Book 100, #16 from the README
+    rep = """
+·   ·   ·   ·   ·
+^                
+· < ·   1   · > ·
+^               v
+·   · > ·   ·   1
+v           v    
+·   ·   ·   · > ·
+                 
+·   ·   ·   ·   ·
+"""
+    grid = Grid(rep)
+    with counting() as counts:
+        hints = iter_hints(grid)
+        assert next(hints) == hint(grid)
+    # the lazy iterator doesn't compute refutation scores for the first hint
+    assert counts["check"] == 0
+
+    # every empty cell is eventually yielded, once
+    cells = [(r, c) for r, c, name, suggestion in hints]
+    assert len(cells) + 1 == len(set(cells)) + 1 == np.sum(grid.values == 0)
+
+
+def test_incremental_refutation_scores():
+    rep = KRAZYDAD_4X4_1_1_3
+    grid = Grid(rep)
+    with counting() as counts:
+        scores = refutation_scores(grid, incremental=True)
+    assert np.all((scores == 0) == (grid.values != 0))
+    # values in satisfying models are not checked
+    assert counts["check"] < 14 * 4
+
+
+def test_memory_bounded_refutation_scores():
+    rep = KRAZYDAD_4X4_1_1_3
+    grid = Grid(rep)
+    with counting() as counts:
+        scores = refutation_scores(grid, recycle_every=10)
+    assert np.all((scores == 0) == (grid.values != 0))
+    # 14 empty cells with 4 values each
+    assert counts["recycle"] == (14 * 4 - 1) // 10
+
+    with pytest.raises(MemoryError):
+        refutation_scores(grid, memory_limit=1)
+    with pytest.raises(ValueError):
+        refutation_scores(grid, incremental=True, recycle_every=10)
+
+
+def test_memory_limit_without_current_memory_use(monkeypatch):
+    import futoshiki
+
+    # where only the peak memory use is known, the limit can't be enforced
+    monkeypatch.setattr(futoshiki, "_rss", lambda: None)
+    grid = Grid(KRAZYDAD_4X4_1_1_3)
+    with pytest.warns(UserWarning):
+        scores = refutation_scores(grid, memory_limit=1)
+    assert np.all((scores == 0) == (grid.values != 0))